@@ -1,12 +1,32 @@
 # streamlit_app.py
 
 import os
+import re
+import hashlib
+import json
+import time
+import wave
+import threading
+import subprocess
+from io import BytesIO
+from collections import OrderedDict
+from pathlib import Path
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import streamlit as st
-import requests
+import httpx
 from gtts import gTTS
-from moviepy.editor import ImageClip, AudioFileClip, TextClip, CompositeVideoClip
-from tempfile import NamedTemporaryFile, mkdtemp
+from mutagen.mp3 import MP3
+from mutagen.wave import WAVE
+from imageio_ffmpeg import get_ffmpeg_exe
+from PIL import Image, ImageDraw, ImageFont
+from tempfile import TemporaryDirectory
+
+try:
+    from piper import PiperVoice
+except ImportError:  # piper-tts is optional; gTTS is used for every language without it
+    PiperVoice = None
 
 # Load .env
 load_dotenv()
@@ -18,6 +38,359 @@ if not API_KEY:
     st.error("Please set the TOGETHER_API_KEY environment variable in your .env")
     st.stop()
 
+SCRIPT_TTL = 24 * 60 * 60  # seconds a generated script is reused for identical inputs
+SCRIPT_CACHE_SIZE = 256
+# A sentence ends at a terminator followed by whitespace, so "₹2.5k" stays in one piece
+SENTENCE_SPLIT = re.compile(r"(?<=[.।。!?])\s+")
+TTS_WORKERS = 4
+FFMPEG = get_ffmpeg_exe()
+CAPTION_FONT = "Amiri-Bold.ttf"
+CAPTION_SIZE = 50
+CAPTION_MARGIN = 20
+VIDEO_WIDTH = 960  # st.video playback size; more pixels only cost encode time and bytes
+API_RETRIES = 3
+ENCODER_PROBE_TIMEOUT = 10  # seconds; a hung GPU driver must not hang the first render
+MAX_CONCURRENT_ENCODES = 4  # ffmpeg processes allowed at once across all sessions
+# On-device Piper voices; languages without one (or without the .onnx in PIPER_VOICE_DIR) use gTTS
+PIPER_VOICE_DIR = Path(os.getenv("PIPER_VOICE_DIR", "voices"))
+PIPER_VOICES = {
+    "hi": "hi_IN-priyamvada-medium",
+    "en": "en_US-lessac-medium"
+}
+# AAC is what every player and upload pipeline expects in MP4; 64k is plenty for speech
+AUDIO_CODEC = ["-c:a", "aac", "-b:a", "64k"]
+AUDIO_INFO = {"mp3": MP3, "wav": WAVE}
+# H.264 encoders in order of preference, each with its fastest low-latency settings.
+# Nothing moves, so one keyframe per 10s is enough; 4:2:0 keeps browsers happy.
+# Quality targets roughly x264 CRF 28; each encoder carries its own rate control because
+# the same flags select different modes per encoder (a -maxrate turns QSV's ICQ into CBR).
+VIDEO_ENCODERS = (
+    ("h264_nvenc", [
+        "-preset", "p1", "-tune", "ll", "-g", "240", "-pix_fmt", "yuv420p",
+        # -b:v 0 makes -cq the target instead of NVENC's 2M default average
+        "-rc", "vbr", "-cq", "28", "-b:v", "0", "-maxrate", "1M", "-bufsize", "2M"
+    ]),
+    ("h264_qsv", [
+        "-preset", "veryfast", "-g", "240", "-pix_fmt", "nv12",
+        # ICQ; only honoured while no -maxrate is set
+        "-global_quality", "28"
+    ]),
+    ("h264_videotoolbox", [
+        "-realtime", "1", "-g", "240", "-pix_fmt", "yuv420p",
+        "-b:v", "1M", "-maxrate", "1M", "-bufsize", "2M"
+    ]),
+    # Software fallback; must stay last, _encode_video retries with it
+    ("libx264", [
+        "-preset", "ultrafast", "-tune", "stillimage", "-threads", "0",
+        "-x264-params", "keyint=240:min-keyint=240", "-pix_fmt", "yuv420p",
+        "-crf", "28", "-maxrate", "1M", "-bufsize", "2M"
+    ]),
+)
+LANGUAGE_MAP = MappingProxyType({
+    "hi": "Hindi",
+    "en": "English",
+    "bn": "Bengali",
+    "ta": "Tamil",
+    "mr": "Marathi"
+})
+
+
+@st.cache_resource(show_spinner=False)
+def _http():
+    # One pooled HTTP/2 client per server process so reruns reuse the TLS connection.
+    # Transport retries cover connection failures; 5xx responses are retried in _stream_script.
+    return httpx.Client(
+        transport=httpx.HTTPTransport(http2=True, retries=API_RETRIES),
+        timeout=30.0,
+        headers={"Authorization": f"Bearer {API_KEY}"}
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _script_cache():
+    # prompt -> (created_at, script), least recently used first, shared by all sessions.
+    # Hand-rolled because a streamed response can't go through st.cache_data.
+    return OrderedDict(), threading.Lock()
+
+
+def _cached_script(prompt):
+    cache, lock = _script_cache()
+    with lock:
+        entry = cache.get(prompt)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= SCRIPT_TTL:
+            del cache[prompt]
+            return None
+        cache.move_to_end(prompt)
+        return entry[1]
+
+
+def _store_script(prompt, script):
+    cache, lock = _script_cache()
+    now = time.time()
+    with lock:
+        cache[prompt] = (now, script)
+        cache.move_to_end(prompt)
+        for key in [k for k, (created_at, _) in cache.items() if now - created_at >= SCRIPT_TTL]:
+            del cache[key]
+        while len(cache) > SCRIPT_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+@st.cache_data(show_spinner=False)
+def _build_prompt(product_name, features, context, lang_code) -> str:
+    feature_list = [f.strip() for f in features.split(",") if f.strip()]
+    return f"""
+Write a 2-sentence sales pitch in {LANGUAGE_MAP[lang_code]} for this product:
+• Name: {product_name}
+• Features: {', '.join(feature_list)}
+Tone: friendly, festive. Context: {context}.
+"""
+
+
+def _stream_script(prompt):
+    payload = {"prompt": prompt, "max_tokens": 150, "stream": True}
+    for attempt in range(API_RETRIES + 1):
+        with _http().stream("POST", TOGETHERKEY_API_URL, json=payload) as resp:
+            if resp.status_code < 500 or attempt == API_RETRIES:
+                yield from _response_tokens(resp)
+                return
+        # Exponential backoff on server errors
+        time.sleep(0.5 * 2 ** attempt)
+
+
+def _response_tokens(resp):
+    if resp.status_code != 200:
+        resp.read()
+        raise RuntimeError(f"Deepseek API error {resp.status_code}: {resp.text}")
+    if not resp.headers.get("content-type", "").startswith("text/event-stream"):
+        # The endpoint ignored "stream": true; Deepseek may return its text under different keys
+        resp.read()
+        data = resp.json()
+        text = data.get("text") or data.get("output") or ""
+        if text:
+            yield text
+        return
+    for line in resp.iter_lines():
+        if not line.startswith("data:"):
+            continue
+        chunk = line[len("data:"):].strip()
+        if chunk == "[DONE]":
+            break
+        data = json.loads(chunk)
+        # OpenAI-style delta first; Deepseek may return its text under different keys
+        choice = (data.get("choices") or [{}])[0]
+        token = (
+            (choice.get("delta") or {}).get("content")
+            or choice.get("text")
+            or data.get("text")
+            or data.get("output")
+            or ""
+        )
+        if token:
+            yield token
+
+
+@st.cache_resource(show_spinner=False)
+def _piper(lang_code):
+    # Loaded once per process; None means fall back to gTTS for this language
+    voice = PIPER_VOICES.get(lang_code)
+    model = PIPER_VOICE_DIR / f"{voice}.onnx"
+    if PiperVoice is None or voice is None or not model.exists():
+        return None
+    return PiperVoice.load(str(model))
+
+
+def _tts_sentence(sentence, lang_code) -> bytes:
+    # Raw 16-bit PCM from Piper, MP3 from gTTS; _join_audio knows which
+    voice = _piper(lang_code)
+    if voice is not None:
+        return b"".join(chunk.audio_int16_bytes for chunk in voice.synthesize(sentence))
+    fp = BytesIO()
+    gTTS(text=sentence, lang=lang_code).write_to_fp(fp)
+    return fp.getvalue()
+
+
+def _join_audio(chunks, lang_code) -> bytes:
+    voice = _piper(lang_code)
+    if voice is None:
+        # MP3 frame streams can be joined by plain concatenation
+        return b"".join(chunks)
+    fp = BytesIO()
+    with wave.open(fp, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(voice.config.sample_rate)
+        wav.writeframes(b"".join(chunks))
+    return fp.getvalue()
+
+
+def _audio_format(lang_code) -> str:
+    return "mp3" if _piper(lang_code) is None else "wav"
+
+
+def _voice_as_streamed(tokens, lang_code, pool, jobs):
+    # Pass tokens through to the UI, handing each finished sentence to TTS in the background
+    buffer = ""
+    for token in tokens:
+        yield token
+        buffer += token
+        # Same split as _synthesize; the last part may still be growing
+        *sentences, buffer = SENTENCE_SPLIT.split(buffer)
+        for sentence in sentences:
+            if sentence.strip():
+                jobs.append(pool.submit(_tts_sentence, sentence.strip(), lang_code))
+    if buffer.strip():
+        jobs.append(pool.submit(_tts_sentence, buffer.strip(), lang_code))
+
+
+def _synthesize(script, lang_code, pool) -> bytes:
+    # Voice each sentence concurrently; wall time is the slowest sentence, not the sum
+    jobs = [
+        pool.submit(_tts_sentence, sentence, lang_code)
+        for sentence in SENTENCE_SPLIT.split(script.strip()) if sentence
+    ]
+    return _join_audio([job.result() for job in jobs], lang_code)
+
+
+def _resize_image(image_bytes) -> Image.Image:
+    # Decode straight from the upload's bytes and scale to the output width once,
+    # up front, with a high-quality filter
+    im = Image.open(BytesIO(image_bytes)).convert("RGB")
+    # yuv420p needs even, non-zero dimensions; very wide banners would otherwise round to 0
+    height = max(2, round(im.height * VIDEO_WIDTH / im.width / 2) * 2)
+    return im.resize((VIDEO_WIDTH, height), Image.LANCZOS)
+
+
+@st.cache_resource(show_spinner=False)
+def _caption_font():
+    try:
+        return ImageFont.truetype(CAPTION_FONT, CAPTION_SIZE)
+    except OSError:
+        # Amiri isn't installed everywhere; Pillow's bundled scalable font keeps captions working
+        return ImageFont.load_default(size=CAPTION_SIZE)
+
+
+def _wrap_caption(draw, text, font, max_width) -> str:
+    # Greedy word wrap, matching what TextClip's method="caption" used to do
+    lines, line = [], ""
+    for word in text.split():
+        candidate = f"{line} {word}".strip()
+        if line and draw.textlength(candidate, font=font) > max_width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    if line:
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _burn_caption(image, script, out_path):
+    # Rasterise the caption in-process and draw it into the still once, so neither
+    # ImageMagick nor a per-frame composite is needed; ffmpeg only loops one image.
+    # The prepared image is shared through the cache, so draw on a copy.
+    frame = image.copy()
+    draw = ImageDraw.Draw(frame)
+    font = _caption_font()
+    draw.multiline_text(
+        (frame.width // 2, frame.height - CAPTION_MARGIN),
+        _wrap_caption(draw, script, font, frame.width - 2 * CAPTION_MARGIN),
+        font=font, anchor="md", align="center",
+        fill="white", stroke_width=2, stroke_fill="black"
+    )
+    frame.save(out_path)
+
+
+@st.cache_resource(show_spinner=False)
+def _video_codec_args():
+    # Probed once per process: prefer a hardware encoder that actually works on this host
+    try:
+        listed = subprocess.run(
+            [FFMPEG, "-hide_banner", "-encoders"],
+            capture_output=True, text=True, timeout=ENCODER_PROBE_TIMEOUT
+        ).stdout
+    except subprocess.TimeoutExpired:
+        listed = ""
+    for codec, params in VIDEO_ENCODERS:
+        codec_args = ["-c:v", codec, *params]
+        if codec == "libx264" or (codec in listed and _encoder_works(codec_args)):
+            return codec_args
+
+
+def _encoder_works(codec_args) -> bool:
+    # Being compiled into ffmpeg doesn't mean the GPU and driver are present.
+    # Probe with exactly the arguments _encode_video will pass.
+    try:
+        probe = subprocess.run([
+            FFMPEG, "-hide_banner", "-f", "lavfi", "-i", "color=s=256x256",
+            "-frames:v", "1", *codec_args, "-f", "null", "-"
+        ], capture_output=True, timeout=ENCODER_PROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return False
+    return probe.returncode == 0
+
+
+@st.cache_resource(show_spinner=False)
+def _encode_slots():
+    # Shared by every session so concurrent users can't oversubscribe the CPU with ffmpeg
+    return threading.BoundedSemaphore(MAX_CONCURRENT_ENCODES)
+
+
+def _encode_video(img_path, audio_bytes, audio_format) -> bytes:
+    # Reading the audio header is far cheaper than letting ffmpeg probe for the end of audio
+    duration = AUDIO_INFO[audio_format](BytesIO(audio_bytes)).info.length
+    codec_args = _video_codec_args()
+    # Only the ffmpeg process holds a slot; TTS and image work run outside it
+    with _encode_slots():
+        try:
+            return _run_ffmpeg(img_path, audio_bytes, audio_format, duration, codec_args)
+        except subprocess.CalledProcessError:
+            if codec_args[1] == "libx264":
+                raise
+            # A hardware encoder that passed the probe can still fail at runtime,
+            # e.g. once a consumer NVENC card runs out of sessions
+            codec, params = VIDEO_ENCODERS[-1]
+            return _run_ffmpeg(img_path, audio_bytes, audio_format, duration, ["-c:v", codec, *params])
+
+
+def _run_ffmpeg(img_path, audio_bytes, audio_format, duration, codec_args) -> bytes:
+    return subprocess.run([
+        FFMPEG,
+        # Decode the composited still once and repeat it inside the filter graph;
+        # "-loop 1" on the input would re-read and re-decode the PNG for every frame
+        "-i", img_path,
+        "-f", audio_format, "-i", "pipe:0",
+        "-vf", "loop=loop=-1:size=1,fps=24",
+        *codec_args,
+        *AUDIO_CODEC, "-t", f"{duration:.3f}",
+        # A fragmented MP4 needs no seek back to write the index, so it can go to stdout
+        "-movflags", "frag_keyframe+empty_moov", "-f", "mp4", "pipe:1"
+    ], input=audio_bytes, check=True, capture_output=True).stdout
+
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _prepare_image(image_digest, _image_bytes) -> Image.Image:
+    # The resized still, kept in memory and keyed on the image hash so new scripts reuse it
+    return _resize_image(_image_bytes)
+
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _render_video(image_digest, script, lang_code, _image, _voice) -> bytes:
+    # Keyed on the image hash, script and language only: a repeat click with the same
+    # inputs skips TTS and encoding. On a miss, _image and _voice are called for the
+    # prepared still and the voice-over bytes.
+    return _render(script, lang_code, _image, _voice)
+
+
+def _render(script, lang_code, image, voice) -> bytes:
+    with TemporaryDirectory() as tmp_dir:
+        img_path = Path(tmp_dir) / "frame.png"
+        _burn_caption(image(), script, img_path)
+        return _encode_video(img_path, voice(), _audio_format(lang_code))
+
+
 # UI
 st.title("Scripted by Her: Vernacular Video Prototype")
 st.write("Generate a short product video with localized script & voice using TogetherKey Deepseek and gTTS.")
@@ -27,81 +400,70 @@ uploaded_file = st.file_uploader("Upload product image", type=["jpg", "jpeg", "p
 product_name = st.text_input("Product Name", "Handcrafted Brass Lamp")
 features = st.text_area("Features (comma-separated)", "eco-friendly, long-lasting, intricate design")
 context = st.text_input("Context (e.g. Diwali gifting)", "Diwali gifting")
-language_map = {
-    "hi": "Hindi",
-    "en": "English",
-    "bn": "Bengali",
-    "ta": "Tamil",
-    "mr": "Marathi"
-}
-language = st.selectbox("Language", list(language_map.keys()), format_func=lambda x: language_map[x])
+language = st.selectbox("Language", list(LANGUAGE_MAP), format_func=LANGUAGE_MAP.get)
 
 if st.button("Generate Video"):
     if not uploaded_file:
         st.error("Please upload a product image first.")
         st.stop()
 
-    # 1) SCRIPT GENERATION via TogetherKey Deepseek
-    with st.spinner("Generating script..."):
-        feature_list = [f.strip() for f in features.split(",") if f.strip()]
-        prompt = f"""
-Write a 2-sentence sales pitch in {language_map[language]} for this product:
-• Name: {product_name}
-• Features: {', '.join(feature_list)}
-Tone: friendly, festive. Context: {context}.
-"""
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
-        payload = {"prompt": prompt, "max_tokens": 150}
-        resp = requests.post(TOGETHERKEY_API_URL, json=payload, headers=headers)
-        if resp.status_code != 200:
-            st.error(f"Deepseek API error {resp.status_code}: {resp.text}")
-            st.stop()
-        data = resp.json()
-        # Deepseek may return its text under different keys
-        script = data.get("text") or data.get("output") or ""
-    st.success("Script generated.")
-    st.write(f"**Script:** {script}")
-
-    # 2) TEXT-TO-SPEECH
-    with st.spinner("Generating voice..."):
-        tts = gTTS(text=script, lang=language)
-        audio_tmp = NamedTemporaryFile(delete=False, suffix=".mp3")
-        tts.save(audio_tmp.name)
-    st.success("Voice generated.")
-
-    # 3) VIDEO ASSEMBLY
-    with st.spinner("Assembling video..."):
-        tmp_dir = mkdtemp()
-        img_path = os.path.join(tmp_dir, "product.png")
-        with open(img_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-
-        duration = 8  # seconds
-        img_clip = ImageClip(img_path).resize(width=1280).set_duration(duration)
-        txt_clip = (
-            TextClip(script, font="Amiri-Bold", fontsize=50, method="caption", align="South")
-            .set_duration(duration)
-            .set_position(("center", "bottom"))
-        )
-        audio_clip = AudioFileClip(audio_tmp.name).set_duration(duration)
-        video = CompositeVideoClip([img_clip, txt_clip]).set_audio(audio_clip)
+    # Not a with-block: its shutdown(wait=True) would make every st.stop() below wait
+    # for the gTTS calls already queued before the error could be shown
+    pool = ThreadPoolExecutor(max_workers=TTS_WORKERS)
+    try:
+        # Resize the image in the background while the script streams in
+        image_bytes = uploaded_file.getvalue()
+        image_digest = hashlib.sha256(image_bytes).hexdigest()
+        image_job = pool.submit(_prepare_image, image_digest, image_bytes)
 
-        video_path = os.path.join(tmp_dir, "product_video.mp4")
-        video.write_videofile(
-            video_path, fps=24, codec="libx264", audio_codec="aac",
-            threads=2, verbose=False, logger=None
-        )
+        # 1) SCRIPT GENERATION via TogetherKey Deepseek, voicing sentences as they stream in
+        prompt = _build_prompt(product_name, features, context, language)
+        script = _cached_script(prompt)
+        if script is not None:
+            st.write(f"**Script:** {script}")
+            voice = lambda: _synthesize(script, language, pool)
+        else:
+            tts_jobs = []
+            st.write("**Script:**")
+            try:
+                script = st.write_stream(
+                    _voice_as_streamed(_stream_script(prompt), language, pool, tts_jobs)
+                )
+            except RuntimeError as e:
+                st.error(str(e))
+                st.stop()
+            except httpx.HTTPError as e:
+                # Connection failures after the transport's retries, or a read timeout mid-stream
+                st.error(f"Deepseek API request failed: {type(e).__name__}: {e}")
+                st.stop()
+            except ValueError as e:
+                # A malformed SSE chunk or JSON body
+                st.error(f"Deepseek API returned an unreadable response: {e}")
+                st.stop()
+            if not isinstance(script, str) or not script.strip():
+                # Don't cache or render an empty reply; the next click should retry the API
+                st.error("Deepseek returned an empty script. Please try again.")
+                st.stop()
+            _store_script(prompt, script)
+            voice = lambda: _join_audio([job.result() for job in tts_jobs], language)
+        st.success("Script generated.")
+
+        # 2) VOICE & VIDEO ASSEMBLY
+        with st.spinner("Generating voice & assembling video..."):
+            try:
+                video_bytes = _render_video(image_digest, script, language, image_job.result, voice)
+            except subprocess.CalledProcessError as e:
+                st.error(f"ffmpeg failed: {e.stderr.decode(errors='replace')[-500:]}")
+                st.stop()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
     st.success("Video generated!")
 
     # Show & download
-    st.video(video_path)
-    with open(video_path, "rb") as vf:
-        st.download_button(
-            label="Download Video",
-            data=vf.read(),
-            file_name=f"{product_name.replace(' ', '_')}.mp4",
-            mime="video/mp4"
-        )
+    st.video(video_bytes)
+    st.download_button(
+        label="Download Video",
+        data=video_bytes,
+        file_name=f"{product_name.replace(' ', '_')}.mp4",
+        mime="video/mp4"
+    )